@@ -16,20 +16,148 @@ Payload example:
         "dataset_id": "<dataset_id>",
         "table_name": "<table_name>",
         "keyword": "<keyword>",
-        "since": "<since_date>"
+        "since": "<since_date>",
+        "max_workers": <optional, concurrent Google Trends requests>,
+        "rate_limit": <optional, Google Trends requests per minute>
         }
     }
 }
 """
+import functools
+import numpy as np
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime
 from pytrends.request import TrendReq
+from pytrends.exceptions import ResponseError
+from requests.exceptions import RequestException
 import logging
-from dateutil.relativedelta import relativedelta
-import logging as log
+import random
+import threading
+import time
 from google.cloud import bigquery
 
 
+MAX_WORKERS = 4
+MAX_RETRIES = 5
+BACKOFF_BASE = 1
+BACKOFF_MAX = 30
+BACKOFF_JITTER = 0.5
+NON_RETRYABLE_STATUS = (400, 403)
+BREAKER_THRESHOLD = 2 * (MAX_RETRIES + 1)
+BREAKER_COOLDOWN = 60
+RATE_LIMIT = 60
+MONTHLY_SINCE = pd.Timestamp("2021-01-01")
+
+_local = threading.local()
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised when the circuit breaker rejects a request to Google Trends.
+    """
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to Google Trends for `cooldown` seconds once `threshold`
+    consecutive requests have failed. When the cooldown is over a single trial request
+    is let through (half open) and every other caller is still rejected until it
+    finishes: a success closes the breaker, a failure opens it again. Callers that
+    pass before_call() must always report back with record_success(),
+    record_failure() or, when the outcome says nothing about Google's health,
+    release().
+
+    Arguments:
+        threshold {int} -- consecutive failures that open the breaker
+        cooldown {int} -- seconds the breaker stays open
+    """
+
+    def __init__(self, threshold=5, cooldown=60):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.open_until = 0.0
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.state == "closed":
+                return
+            if self.state == "open" and time.monotonic() >= self.open_until:
+                self.state = "half_open"
+                return
+            raise CircuitOpenError(
+                f"Google Trends circuit {self.state} after {self.failures} failures"
+            )
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.threshold:
+                self.state = "open"
+                self.open_until = time.monotonic() + self.cooldown
+
+    def release(self):
+        with self._lock:
+            if self.state == "half_open":
+                self.state = "open"
+
+
+class RateLimiter:
+    """
+    Token bucket shared by every thread that calls Google Trends. Requests start at a
+    steady `rate` per `period` seconds and at most `burst` can start back to back, so
+    in any window of t seconds at most burst + rate * t / period requests start. The
+    pool workers pace themselves together instead of each one only backing off after
+    Google answers with a 429.
+
+    Arguments:
+        rate {int} -- requests allowed per period
+        period {float} -- length of the period in seconds
+        burst {int} -- requests that can start without waiting
+    """
+
+    def __init__(self, rate=60, period=60.0, burst=1):
+        self.rate = rate
+        self.period = period
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                refill = (now - self.updated) * self.rate / self.period
+                self.tokens = min(self.burst, self.tokens + refill)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) * self.period / self.rate
+            time.sleep(wait)
+
+    def reset(self, rate, burst):
+        with self._lock:
+            self.rate = rate
+            self.burst = burst
+            self.tokens = float(burst)
+            self.updated = time.monotonic()
+
+
+_breaker = CircuitBreaker(BREAKER_THRESHOLD, BREAKER_COOLDOWN)
+_limiter = RateLimiter(RATE_LIMIT, burst=MAX_WORKERS)
+
+
 def config_log():
 
     """
@@ -39,10 +167,10 @@ def config_log():
     today = datetime.today().strftime("%Y%m%d")
     logging_level = 20
     # log_filename = f'logs/instagram_organic_{today}.log'
-    log.basicConfig(
+    logging.basicConfig(
         # filename=log_filename,
         level=logging_level,
-        format=f'[%(asctime)s.%(msecs)03d] %(levelname)s: %(funcName)s: %(message)s',
+        format='[%(asctime)s.%(msecs)03d] %(levelname)s: %(funcName)s: %(message)s',
         datefmt='%Y-%m-%d %H:%M:%S',
         force=True)
     
@@ -66,74 +194,159 @@ def payload(request_json):
     else:
         return ("Payload error", 400)
 
+def get_pytrend():
+    '''
+    Returns the TrendReq of the current thread, creating it on first use. Reusing
+    it across requests skips the Google cookie round trip done by TrendReq().
+    '''
+    pytrend = getattr(_local, "pytrend", None)
+    if pytrend is None:
+        pytrend = TrendReq()
+        _local.pytrend = pytrend
+    return pytrend
+
+def fetch_interest(pytrend, timeframe, config):
+    '''
+    Builds the pytrends payload for the configured keyword and timeframe and returns
+    the interest over time. Transient failures are retried up to MAX_RETRIES times,
+    waiting exponentially longer (capped at BACKOFF_MAX seconds, plus up to
+    BACKOFF_JITTER of random jitter) between attempts. Client errors listed in
+    NON_RETRYABLE_STATUS are not retried.
+
+    Every attempt goes through the shared circuit breaker, which raises
+    CircuitOpenError instead of calling Google once BREAKER_THRESHOLD consecutive
+    attempts have hit a 429, a 5xx or a connection error; other errors leave its
+    count alone. The threshold is above one request's MAX_RETRIES + 1
+    attempts, so a single failing timeframe cannot open the breaker on its own. Each
+    attempt then waits on the shared rate limiter (config["rate_limit"] requests per
+    minute, RATE_LIMIT by default).
+    The payload is only built once: retries after a failed interest_over_time()
+    reuse its widget token instead of requesting a new one.
+    '''
+    payload_built = False
+    for attempt in range(MAX_RETRIES + 1):
+        _breaker.before_call()
+        _limiter.acquire()
+        try:
+            if not payload_built:
+                pytrend.build_payload(kw_list=[config["keyword"]],timeframe=timeframe, geo='BR')
+                payload_built = True
+            hits = pytrend.interest_over_time()
+        except (ResponseError, RequestException) as error:
+            logger.warning("pytrends error on %s: %s", timeframe, error)
+            status = getattr(getattr(error, "response", None), "status_code", None)
+            if status is None or status == 429 or status >= 500:
+                _breaker.record_failure()
+            else:
+                _breaker.release()
+            if status in NON_RETRYABLE_STATUS:
+                logger.error("Giving up on timeframe %s: status %s", timeframe, status)
+                break
+            if attempt < MAX_RETRIES:
+                delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)
+                time.sleep(delay * (1 + random.uniform(0, BACKOFF_JITTER)))
+        except Exception:
+            _breaker.release()
+            raise
+        else:
+            _breaker.record_success()
+            return hits
+    return None
+
+def fetch_hits(timerange, config):
+    '''
+    Collects daily interest over time from Google Trends for a single time range.
+    It uses the TrendReq of the calling thread so it can safely run on a worker thread.
+    '''
+    logger.info("Collecting interest over time from timerange %s", timerange)
+    return fetch_interest(get_pytrend(), timerange, config)
+
 def get_hits(time_ranges, config):
     '''
     Collects daily interest over time from Google Trends for a given time range and 
-    returns a pandas dataframe with the results. It uses the pytrends package to build 
-    a payload with the specified keyword and time range and collects the interest over time data. 
-    If there is an error, it retries up to 5 times.
+    returns a pandas dataframe with the results, indexed by (year, month). The time
+    ranges are fetched concurrently with fetch_hits() on a thread pool of
+    config["max_workers"] threads (MAX_WORKERS by default), kept small so Google does
+    not rate limit the requests. time_ranges must only contain periods that have
+    already started, as built by etl().
     '''
-    logging.info('Collecting interest over time:')
-    pytrend = TrendReq()
-    trends = pd.DataFrame()     
-    for timerange in time_ranges:
-        attempts=0
-        logging.info(f"Collecting interest over time from timerange {timerange}")
-        print(f"Collecting interest over time from timerange {timerange}")
-        if datetime.strptime(timerange.split()[0], "%Y-%m-%d") <= datetime.today():    
-            while attempts <= 5:
-                try:
-                    pytrend.build_payload(kw_list=[config["keyword"]],timeframe=timerange, geo='BR')
-                    hits = pytrend.interest_over_time()                    
-                    trends = pd.concat([trends, hits])
-                    break
-                except:
-                    attempts = attempts + 1
-                    print(f"pytrends Error")
-                else:
-                    attempts = attempts + 1
-        else:
-            print(f"skip {timerange}")
+    logger.info('Collecting interest over time:')
+    max_workers = int(config.get("max_workers", MAX_WORKERS))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        frames = [
+            hits for hits in executor.map(lambda timerange: fetch_hits(timerange, config), time_ranges)
+            if hits is not None
+        ]
+    trends = pd.concat(frames) if frames else pd.DataFrame()
     if not trends.empty:
-        trends.reset_index(inplace = True)
-        trends = trends.drop("isPartial", axis=1)
-        trends["month"] = pd.to_datetime(trends["date"], format = "%Y-%m-%d").dt.month
-        trends["year"] = pd.to_datetime(trends["date"], format = "%Y-%m-%d").dt.year
+        kw = config["keyword"]
+        dates = trends.index
+        if not pd.api.types.is_datetime64_any_dtype(dates):
+            dates = pd.to_datetime(dates, format = "%Y-%m-%d")
+        trends = pd.DataFrame(
+            {"date": dates, kw: trends[kw].to_numpy().astype("uint8")},
+            index=pd.MultiIndex.from_arrays(
+                [dates.year.astype("int16"), dates.month.astype("int8")],
+                names=["year", "month"]
+            )
+        )
     return trends
 
 def get_monthly(config):
     '''
     Collects monthly interest over time from Google Trends for all time and returns a 
-    pandas dataframe with the results. It uses the pytrends package to build a payload 
-    with the specified keyword and collects the interest over time data. If there is an 
-    error, it retries up to 5 times.
+    pandas dataframe with the results, indexed by (year, month). It uses the pytrends
+    package to build a payload with the specified keyword and collects the interest
+    over time data through fetch_interest(), which retries failed requests with
+    exponential backoff.
     '''
-    logging.info('Collecting interest over time all time:')
-    pytrend = TrendReq()
-    hits_all = None
-    t=0
-    while t <= 5:
-        try:
-            pytrend.build_payload(kw_list=[config["keyword"]],timeframe='all', geo='BR')
-            hits_all = pytrend.interest_over_time()
-            break
-        except:
-            t = t + 1
-            print(f"pytrends Error")
-        else:
-            t = t + 1      
+    logger.info('Collecting interest over time all time:')
+    hits_all = fetch_interest(get_pytrend(), 'all', config)
     if hits_all is not None:
-        hits_all.reset_index(inplace = True)
-        hits_all = hits_all.drop("isPartial", axis=1)
-        hits_all = hits_all[(hits_all['date'] >= '2021-01-01')]
-        hits_all = hits_all.rename(columns={f'{config["keyword"]}': f'{config["keyword"]}_monthly'})
-        hits_all["month"] = pd.to_datetime(hits_all["date"], format = "%Y-%m-%d").dt.month
-        hits_all["year"] = pd.to_datetime(hits_all["date"], format = "%Y-%m-%d").dt.year
-        hits_all = hits_all.drop("date", axis=1)
-        
+        kw = config["keyword"]
+        dates = hits_all.index
+        if not pd.api.types.is_datetime64_any_dtype(dates):
+            dates = pd.to_datetime(dates, format = "%Y-%m-%d")
+        mask = dates >= MONTHLY_SINCE
+        dates = dates[mask]
+        hits_all = pd.DataFrame(
+            {f"{kw}_monthly": hits_all[kw].to_numpy()[mask].astype("uint8")},
+            index=pd.MultiIndex.from_arrays(
+                [dates.year.astype("int16"), dates.month.astype("int8")],
+                names=["year", "month"]
+            )
+        )
+
     return hits_all 
 
 
+@functools.lru_cache(maxsize=4)
+def get_bigquery_client(project_id):
+    """
+    Returns a BigQuery client for the project, created once and then reused so
+    later loads skip the credentials lookup and connection setup.
+
+    Arguments:
+        project_id {str} -- BigQuery project id
+    """
+    return bigquery.Client(project_id)
+
+
+def bigquery_schema(keyword):
+    """
+    Builds the schema of the table written by save_data(), so the load job does not
+    have to infer it.
+
+    Arguments:
+        keyword {str} -- keyword used to name the trends columns
+    """
+    return [
+        bigquery.SchemaField("date", "DATETIME"),
+        bigquery.SchemaField(f"{keyword}_monthly", "INTEGER"),
+        bigquery.SchemaField(f"{keyword}_daily", "FLOAT"),
+    ]
+
+
 def bigquery_save_data(data, config):
     """
     Function saves the data to a BigQuery table. 
@@ -145,17 +358,17 @@ def bigquery_save_data(data, config):
         data {df} -- df data to be loaded
     """
 
-    log.info(f"Loading data to {config['table_name']}")
+    logger.info("Loading data to %s", config['table_name'])
 
-    bigquery_client = bigquery.Client(config["project_id"])
+    bigquery_client = get_bigquery_client(config["project_id"])
     dataset = bigquery_client.dataset(config["dataset_id"])
     table_ref = dataset.table(config["table_name"])
 
     job_config = bigquery.LoadJobConfig()
     job_config.create_disposition = "CREATE_IF_NEEDED"
     #job_config.time_partitioning = bigquery.table.TimePartitioning()
-    #job_config.schema = schema
-    job_config.autodetect = True
+    job_config.schema = bigquery_schema(config["keyword"])
+    job_config.source_format = bigquery.SourceFormat.PARQUET
     job_config.write_disposition = "WRITE_TRUNCATE"
 
     job = bigquery_client.load_table_from_dataframe(
@@ -167,28 +380,32 @@ def bigquery_save_data(data, config):
     try:
         job.result()
     except Exception:
-        log.error(job.errors)
+        logger.error(job.errors)
 
 
 
 def save_data(daily, monthly, config):
     """
     function saves the daily and monthly data to BigQuery tables. 
-    It first merges the daily and monthly dataframes and then saves the merged 
-    dataframe to a BigQuery table using the bigquery_save_data() function.
+    It first joins the daily and monthly dataframes on their (year, month) index and
+    then saves the joined dataframe to a BigQuery table using the bigquery_save_data() function.
 
     Arguments:
         daily {df} -- daily data from grends
         monthly {df} -- monthly data from gtrends
         config {dict} -- configuration with BigQuery params
     """    
-    logging.info(f"Transform and save data into {config['table_name']}")
+    logger.info("Transform and save data into %s", config['table_name'])
     kw = config['keyword']
-    df = pd.merge(daily, monthly, how="left", on=["year", "month"])
-    df = df.drop(["month", "year"], axis=1)
-    df[f"{kw}_daily"] = df[kw]*df[f"{kw}_monthly"]/100
-    df = df.drop([kw], axis=1)
-    print(df)
+    df = daily.join(monthly, how="left", validate="m:1").reset_index(drop=True)
+    adjusted = np.multiply(df[kw].to_numpy(), df[f"{kw}_monthly"].to_numpy(), dtype="float64")
+    adjusted *= 0.01
+    df = pd.DataFrame({
+        "date": df["date"],
+        f"{kw}_monthly": df[f"{kw}_monthly"].astype("Int64"),
+        f"{kw}_daily": adjusted,
+    })
+    logger.debug("save_data: %d rows, cols=%s", len(df), list(df.columns))
     bigquery_save_data(df, config)
 
     return f'Saved'
@@ -200,39 +417,33 @@ def etl(config):
     based on the input configuration config.
     
     The function first generates a list of monthly periods from config["since"] 
-    until the current month using the pd.date_range() function from the pandas library. 
-    It then iterates through this list and transforms each period to a string representing 
-    the first and last day of that month.
-
-    Next, the function calls the get_hits() and get_monthly() functions to extract data from 
-    an external source and transform it into pandas DataFrames. These DataFrames are then passed
+    until the current month using the pd.date_range() function from the pandas library, 
+    so no period starts in the future. Each period is then turned into a string with
+    the first and last day of that month, using pd.offsets.MonthEnd over the whole
+    range at once.
+
+    Next, the function calls the get_hits() and get_monthly() functions, running
+    get_monthly() on its own thread while get_hits() runs, to extract data from an
+    external source and transform it into pandas DataFrames. These DataFrames are then passed
     to the save_data() function to be loaded into a database or file, as specified in the config 
     parameter.
     '''
-    PERIODOS = pd.date_range(
-        config["since"],
-        date.today().strftime(
-            "%Y-%m-%d"
-        ),
-        freq='MS'
-    ).strftime(
-        "%Y-%m-%d"
-    ).tolist()
-
-    for i in range(len(PERIODOS)):
-        first_date = PERIODOS[i]
-        last_day = (
-            datetime.strptime(
-                first_date, 
-                "%Y-%m-%d"
-            ) + relativedelta(months=+1) + relativedelta(days=-1)
-            ).strftime(
-            "%Y-%m-%d"
-        )
-        PERIODOS[i] = first_date + " " + last_day
-        
-    daily = get_hits(PERIODOS, config)
-    monthly = get_monthly(config)
+    starts = pd.date_range(config["since"], date.today(), freq='MS')
+    ends = starts + pd.offsets.MonthEnd(0)
+    PERIODOS = (starts.strftime("%Y-%m-%d") + " " + ends.strftime("%Y-%m-%d")).tolist()
+    _limiter.reset(
+        int(config.get("rate_limit", RATE_LIMIT)),
+        int(config.get("max_workers", MAX_WORKERS)),
+    )
+
+    try:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            monthly = executor.submit(get_monthly, config)
+            daily = get_hits(PERIODOS, config)
+            monthly = monthly.result()
+    except CircuitOpenError as error:
+        logger.error("Stopping the ETL without saving: %s", error)
+        return ("not ok", 500)
     #print(daily.head(3), monthly.head(3))
     save_data(daily, monthly, config)
 
@@ -244,6 +455,6 @@ def main(request):
     config = payload(request_json)
     status_code = etl(config)
 
-    if status_code == 500:
+    if status_code[1] == 500:
         return ("not ok", 500)
     return ("ok", 200)